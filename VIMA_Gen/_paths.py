@@ -0,0 +1,22 @@
+"""
+Project-root sys.path setup shared by the VIMA_Gen modules.
+"""
+from __future__ import annotations
+
+import os
+import sys
+
+# Project root (containing vima_bench), resolved once when this module is first imported.
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def ensure_on_path() -> None:
+    """
+    Put the project root on sys.path so `from vima_bench.tasks...` resolves when
+    running scripts from inside VIMA_Gen directly. Skipped when
+    VIMA_SKIP_PATH_SETUP=1 (e.g. vima_bench is installed).
+    """
+    if os.environ.get("VIMA_SKIP_PATH_SETUP") == "1":
+        return
+    if ROOT_DIR not in sys.path:
+        sys.path.insert(0, ROOT_DIR)
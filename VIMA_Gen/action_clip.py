@@ -0,0 +1,38 @@
+"""
+按动作空间上下界裁剪 oracle 动作，verifier 与 scripts/verify_task.py 共用。
+"""
+from __future__ import annotations
+
+from typing import Callable, Dict, Tuple
+
+import numpy as np
+
+
+def make_action_clipper(
+    action_space,
+) -> Tuple[Dict[str, np.ndarray], Callable[[dict], None]]:
+    """
+    上下界与输出缓冲只分配一次，返回 (action_dict, clip_into)：
+    clip_into(action) 把 oracle 输出逐项 clip 写入 action_dict 的 float32 缓冲，
+    每步传给 env.step 的都是同一个 action_dict，循环内不再新建 dict / 数组。
+    """
+    bounds = {
+        k: (
+            np.ascontiguousarray(sp.low, dtype=np.float32),
+            np.ascontiguousarray(sp.high, dtype=np.float32),
+        )
+        for k, sp in action_space.spaces.items()
+    }
+    scratch = {k: np.empty(sp.shape, dtype=np.float32) for k, sp in action_space.spaces.items()}
+
+    def clip_into(action: dict) -> None:
+        # 缓冲跨步复用：缺项会把未初始化 / 上一步的值送进 env.step，必须显式报错
+        if action.keys() != bounds.keys():
+            raise KeyError(
+                f"oracle 动作的键 {sorted(action)} 与动作空间 {sorted(bounds)} 不一致"
+            )
+        for k, v in action.items():
+            lo, hi = bounds[k]
+            np.clip(v, lo, hi, out=scratch[k])
+
+    return dict(scratch), clip_into
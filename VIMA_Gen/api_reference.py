@@ -4,27 +4,49 @@ Only lists modules/symbols that exist so the model does not call non-existent to
 """
 from __future__ import annotations
 
-import os
-import sys
+import functools
+from typing import Tuple
 
-_THIS_DIR = os.path.dirname(os.path.abspath(__file__))
-_ROOT_DIR = os.path.dirname(_THIS_DIR)
-if _ROOT_DIR not in sys.path:
-    sys.path.insert(0, _ROOT_DIR)
+from _paths import ensure_on_path
 
+ensure_on_path()
 
+# vima_bench's encyclopedia is heavy to import; load it once on first use.
+_enc = None
+
+
+def _get_enc():
+    global _enc
+    if _enc is None:
+        import vima_bench.tasks.components.encyclopedia as enc_mod
+
+        _enc = enc_mod
+    return _enc
+
+
+@functools.lru_cache(maxsize=1)
+def get_entry_names() -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """
+    ObjPedia / TexturePedia entry names, enumerated once per process so any
+    consumer can reuse them. The first call imports the encyclopedia.
+    """
+    enc = _get_enc()
+    return tuple(m.name for m in enc.ObjPedia), tuple(m.name for m in enc.TexturePedia)
+
+
+@functools.lru_cache(maxsize=1)
 def get_api_reference_text() -> str:
     """
     Build a comprehensive reference string including:
     - Allowed imports
     - ObjPedia/TexturePedia entries
     - Code reference from base.py, utils, components
+
+    The string is built once per process and cached.
     """
-    import vima_bench.tasks.components.encyclopedia as enc
     from code_reference import get_code_reference_text
 
-    obj_names = [m.name for m in enc.ObjPedia]
-    tex_names = [m.name for m in enc.TexturePedia]
+    obj_names, tex_names = get_entry_names()
 
     # 基础 API 列表
     basic_lines = [
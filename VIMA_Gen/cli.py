@@ -1,9 +1,11 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import concurrent.futures as cf
 import os
 os.environ.setdefault("KMP_DUPLICATE_LIB_OK", "TRUE")
-from typing import Optional
+from typing import Dict, List, Optional
 
 from api_reference import get_api_reference_text
 from failed_store import append_failed, get_past_failures_for_prompt
@@ -12,7 +14,8 @@ from rag_generator import (
     propose_new_task,
     generate_new_task_code,
 )
-from verifier import verify_task_code, extract_task_name_literal
+from task_index import get_existing_task_names_and_docs
+from verifier import verify_task_code, verify_task_codes, extract_task_name_literal
 
 
 def save_task_code(
@@ -31,6 +34,86 @@ def save_task_code(
     return path
 
 
+async def _generate_codes_concurrently(
+    proposals: List[Dict[str, str]],
+    batch_size: int,
+    **kwargs,
+) -> List[Optional[str]]:
+    """Split proposals into batches of batch_size and run the Step-2 calls concurrently."""
+    batch_size = max(1, batch_size)
+    batches = [proposals[i : i + batch_size] for i in range(0, len(proposals), batch_size)]
+    results = await asyncio.gather(
+        *(generate_new_task_code(tasks=batch, **kwargs) for batch in batches),
+        return_exceptions=True,
+    )
+    codes: List[Optional[str]] = []
+    for batch, result in zip(batches, results):
+        if isinstance(result, BaseException):
+            names = ", ".join(t["task_name"] for t in batch)
+            print(f"[RAG] Step 2 失败（{names}）：{result}")
+            codes.extend([None] * len(batch))
+        else:
+            codes.extend(result)
+    return codes
+
+
+async def _propose_and_generate(
+    args: argparse.Namespace,
+    retriever_future: cf.Future,
+    api_reference: str,
+    past_failures_text: str,
+) -> Optional[tuple[List[Dict[str, str]], List[Optional[str]]]]:
+    """Step 1 提议 + 等待检索器 + Step 2 生成代码；任一步无法继续时返回 None。"""
+    # Step 1: Propose task names and descriptions (one batched call for all candidates)
+    print(f"[RAG] Step 1: 提出 {args.n} 个任务名与描述...")
+    try:
+        proposals = await propose_new_task(
+            n=args.n,
+            model_name=args.model,
+            temperature=args.temperature,
+            hint_brief=args.brief,
+        )
+    except Exception as e:
+        print(f"[RAG] Step 1 失败：{e}")
+        return None
+    for i, proposal in enumerate(proposals):
+        print(f"[RAG] 提议 #{i + 1}: task_name={proposal['task_name']}, group={proposal['group']}")
+        print(f"[RAG] 描述: {proposal['task_description']}")
+
+    # 与已有任务（或同批次前面的提议）重名的候选必然无法使用，跳过其第二步
+    taken_names = {full.split("/", 1)[-1] for full, _ in get_existing_task_names_and_docs()}
+    unique_proposals = []
+    for proposal in proposals:
+        if proposal["task_name"] in taken_names:
+            print(f"[RAG] 跳过 {proposal['task_name']}：与已有任务重名。")
+            continue
+        taken_names.add(proposal["task_name"])
+        unique_proposals.append(proposal)
+    proposals = unique_proposals
+    if not proposals:
+        print("[RAG] 没有可用的新任务提议。")
+        return None
+
+    try:
+        retriever = await asyncio.wrap_future(retriever_future)
+    except Exception as e:
+        print(f"[RAG] 构建检索器失败：{e}")
+        return None
+
+    # Step 2: Generate code (batches of --batch-size candidates, requested concurrently)
+    print("[RAG] Step 2: 生成代码...")
+    codes = await _generate_codes_concurrently(
+        proposals,
+        batch_size=args.batch_size,
+        retriever=retriever,
+        api_reference=api_reference,
+        past_failures_text=past_failures_text,
+        model_name=args.model,
+        temperature=args.temperature,
+    )
+    return proposals, codes
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(
         description="两步生成 VIMA 新任务：① 提出任务名与描述 ② 生成代码并验证。"
@@ -47,12 +130,24 @@ def main() -> None:
         default=1,
         help="生成候选任务数量（默认 1）。",
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=4,
+        help="第二步每次 LLM 调用生成的任务数；多个批次并发请求（默认 4）。",
+    )
     parser.add_argument(
         "--k",
         type=int,
         default=5,
         help="RAG 检索时使用的文档个数（默认 5）。",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="验证进程数；大于 1 时用进程池并行验证所有候选（默认 1，逐个验证并打印详细过程）。",
+    )
     parser.add_argument(
         "--save",
         action="store_true",
@@ -72,48 +167,34 @@ def main() -> None:
     )
     args = parser.parse_args()
 
-    print("[RAG] 构建任务检索器（内置 + 已生成任务）...")
-    retriever = build_retriever(k=args.k)
+    # Step 1 does not need the retriever: build it in the background while the
+    # Step-1 request is in flight and only wait for it right before Step 2.
+    print("[RAG] 后台构建任务检索器（内置 + 已生成任务）...")
+    executor = cf.ThreadPoolExecutor(max_workers=1)
+    retriever_future = executor.submit(build_retriever, args.k)
+    executor.shutdown(wait=False)
     api_reference = get_api_reference_text()
     past_failures_text = get_past_failures_for_prompt()
 
-    for i in range(args.n):
+    # Step 1 和 Step 2 在同一个事件循环里跑：ChatOpenAI 默认共享进程级的异步 HTTP 客户端，
+    # 分两次 asyncio.run 时 Step 2 会复用 Step 1 已关闭循环上的连接而报 "Event loop is closed"。
+    result = asyncio.run(_propose_and_generate(args, retriever_future, api_reference, past_failures_text))
+    if result is None:
+        return
+    proposals, codes = result
+
+    parallel_results = None
+    if args.workers > 1:
+        print(f"[RAG] 使用 {args.workers} 个进程并行验证候选代码...")
+        parallel_results = iter(
+            verify_task_codes([c for c in codes if c is not None], max_workers=args.workers)
+        )
+
+    for i, (proposal, code) in enumerate(zip(proposals, codes)):
         print(f"\n========== 候选任务 #{i + 1} ==========")
-
-        # Step 1: Propose task name and description
-        print("[RAG] Step 1: 提出任务名与描述...")
-        try:
-            proposal = propose_new_task(
-                retriever=retriever,
-                model_name=args.model,
-                temperature=args.temperature,
-                hint_brief=args.brief,
-            )
-        except Exception as e:
-            print(f"[RAG] Step 1 失败：{e}")
-            continue
-
         task_name = proposal["task_name"]
-        group = proposal["group"]
-        task_description = proposal["task_description"]
-        print(f"[RAG] 提议: task_name={task_name}, group={group}")
-        print(f"[RAG] 描述: {task_description}")
-
-        # Step 2: Generate code
-        print("[RAG] Step 2: 生成代码...")
-        try:
-            code = generate_new_task_code(
-                task_name=task_name,
-                task_description=task_description,
-                group=group,
-                retriever=retriever,
-                api_reference=api_reference,
-                past_failures_text=past_failures_text,
-                model_name=args.model,
-                temperature=args.temperature,
-            )
-        except Exception as e:
-            print(f"[RAG] Step 2 失败：{e}")
+        if code is None:
+            print(f"[RAG] Step 2 未得到任务 {task_name} 的代码，跳过。")
             continue
 
         print(f"[RAG] 生成任务的 task_name: {extract_task_name_literal(code) or task_name}")
@@ -122,10 +203,18 @@ def main() -> None:
         print("\n".join(preview_lines))
         print("----- 预览结束 -----\n")
 
-        ok, failed_step, error_msg = verify_task_code(code, verbose=True)
+        if parallel_results is not None:
+            ok, failed_step, error_msg = next(parallel_results)
+            if not ok and failed_step is None:
+                # 验证进程本身崩溃，不是代码的问题：不计入失败记录
+                print(f"[VERIFY] {error_msg}（不记录为失败样本）")
+            elif not ok:
+                print(f"[VERIFY][Step {failed_step}] 失败：{error_msg}")
+        else:
+            ok, failed_step, error_msg = verify_task_code(code, verbose=True)
         if not ok and failed_step is not None and error_msg is not None:
             append_failed(code, failed_step, error_msg, task_name=task_name)
-            print("[RAG] 已将该次失败记录到 failed_generations.json。")
+            print("[RAG] 已将该次失败记录到 failed_generations.jsonl。")
         print(f"[RAG] 验证结果：{'通过' if ok else '失败'}")
 
         if args.save and ok:
@@ -3,13 +3,9 @@
 """
 from __future__ import annotations
 
-import os
-import sys
+from _paths import ensure_on_path
 
-_THIS_DIR = os.path.dirname(os.path.abspath(__file__))
-_ROOT_DIR = os.path.dirname(_THIS_DIR)
-if _ROOT_DIR not in sys.path:
-    sys.path.insert(0, _ROOT_DIR)
+ensure_on_path()
 
 
 def get_code_reference_text() -> str:
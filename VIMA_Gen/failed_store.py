@@ -3,28 +3,69 @@
 """
 from __future__ import annotations
 
+import functools
 import json
 import os
 from typing import List
 
 # 存储文件放在 VIMA_Gen 目录下
 _THIS_DIR = os.path.dirname(os.path.abspath(__file__))
-DEFAULT_PATH = os.path.join(_THIS_DIR, "failed_generations.json")
+DEFAULT_PATH = os.path.join(_THIS_DIR, "failed_generations.jsonl")
 
 # 单条代码预览最大行数；最多保留的失败条数
 CODE_SNIPPET_LINES = 35
 MAX_ENTRIES = 25
+# 文件超过该大小才考虑压缩，追加时只需一次 stat。单条记录（含代码片段）约 1.4 KB，
+# 70 KiB 约为 2 * MAX_ENTRIES 条
+COMPACT_BYTES = 70 * 1024
 
 
-def _load_raw(path: str) -> List[dict]:
+def _read_lines(path: str) -> List[str]:
     if not os.path.isfile(path):
         return []
     try:
         with open(path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-    except (json.JSONDecodeError, OSError):
+            return [line for line in f if line.strip()]
+    except OSError:
         return []
-    return data if isinstance(data, list) else []
+
+
+def _load_raw(path: str) -> List[dict]:
+    """读取 JSONL，每行一条记录；跳过损坏的行，只返回最近 MAX_ENTRIES 条。"""
+    return _parse_lines(_read_lines(path))
+
+
+def _parse_lines(lines: List[str]) -> List[dict]:
+    data: List[dict] = []
+    for line in lines:
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(entry, dict):
+            data.append(entry)
+    return data[-MAX_ENTRIES:]
+
+
+def _maybe_compact(path: str) -> None:
+    """
+    文件超过 COMPACT_BYTES 时重写，只保留最近 MAX_ENTRIES 条；未超过时不读文件。
+    先写临时文件再 os.replace，中途中断也不会留下半截文件。
+    """
+    try:
+        if os.path.getsize(path) <= COMPACT_BYTES:
+            return
+    except OSError:
+        return
+    lines = _read_lines(path)
+    if len(lines) <= MAX_ENTRIES:
+        # 条数不多但单条很长：压缩也省不下空间
+        return
+    data = _parse_lines(lines)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in data))
+    os.replace(tmp_path, path)
 
 
 def append_failed(
@@ -46,18 +87,18 @@ def append_failed(
         "error": error_message.strip(),
         "code_snippet": snippet,
     }
-    data = _load_raw(path)
-    data.append(entry)
-    if len(data) > MAX_ENTRIES:
-        data = data[-MAX_ENTRIES:]
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    # 追加写入一行，O(1)；历史过长时再整体压缩
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    _maybe_compact(path)
+    get_past_failures_for_prompt.cache_clear()
 
 
+@functools.lru_cache(maxsize=1)
 def get_past_failures_for_prompt(path: str = DEFAULT_PATH) -> str:
     """
     读取历史失败记录并格式化为可注入提示词的一段文本。
-    若没有记录则返回空字符串。
+    若没有记录则返回空字符串。结果会缓存，append_failed 时失效。
     """
     data = _load_raw(path)
     if not data:
@@ -3,84 +3,120 @@ Two-step RAG generation: (1) propose task name + description, (2) generate code.
 """
 from __future__ import annotations
 
+import functools
+import hashlib
+import json
+import os
 import re
-from typing import Any, Dict, List
+import shutil
+from typing import Any, Dict, List, Optional
 
+import faiss
+import tiktoken
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain.schema import Document
 
-from task_index import load_all_task_docs, get_existing_task_names_and_docs, TaskDoc
+from task_index import CACHE_DIR, CHUNK_OVERLAP, load_all_task_docs, get_existing_task_names_and_docs, TaskDoc
 
 
 # ---------- Step 1: Propose task name and description ----------
 
 PROMPT_STEP1_SYSTEM = """You are an expert in the VIMA-Bench task suite.
 
-Given the list of EXISTING task names and their short descriptions below, propose ONE new task that:
-- Has a unique task_name (snake_case, not in the existing list).
+Given the list of EXISTING task names and their short descriptions below, propose N new tasks where each task:
+- Has a unique task_name (snake_case, not in the existing list and not repeated among your proposals).
 - Has a clear one- or two-sentence task_description (what the agent must do).
 - Fits one of the existing groups: instruction_following, constraint_satisfaction, novel_concept_grounding, one_shot_imitation, rearrangement, require_memory, require_reasoning.
 
-Output format (use exactly this structure, no extra text):
-TASK_NAME: <snake_case_name>
-GROUP: <one of the groups above>
-TASK_DESCRIPTION: <one or two sentences>
+Output format: return N proposals as a JSON array, no extra text:
+[{"task_name": "<snake_case_name>", "group": "<one of the groups above>", "task_description": "<one or two sentences>"}, ...]
 """
 
 
-def propose_new_task(
-    retriever,
+def _parse_proposals(content: str) -> List[Dict[str, str]]:
+    """
+    Parse the Step-1 JSON array, tolerating a surrounding ```json fence or preamble:
+    decode from each `[` in turn until one yields an array of objects.
+    """
+    decoder = json.JSONDecoder()
+    items = None
+    start = content.find("[")
+    while start >= 0:
+        try:
+            candidate, _ = decoder.raw_decode(content, start)
+        except json.JSONDecodeError:
+            candidate = None
+        if isinstance(candidate, list) and any(isinstance(item, dict) for item in candidate):
+            items = candidate
+            break
+        start = content.find("[", start + 1)
+    if items is None:
+        raise ValueError("LLM 没有返回 JSON 数组。\n完整回复：\n" + content)
+
+    proposals: List[Dict[str, str]] = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        task_name = str(item.get("task_name") or "").strip() or "generated_task"
+        group = str(item.get("group") or "").strip() or "instruction_following"
+        task_description = str(item.get("task_description") or "").strip()
+        proposals.append(
+            {"task_name": task_name, "group": group, "task_description": task_description}
+        )
+    return proposals
+
+
+_EXISTING_TEXT: Optional[str] = None
+
+
+def _existing_tasks_text() -> str:
+    """Bullet list of existing tasks for the Step-1 prompt, built once per process."""
+    global _EXISTING_TEXT
+    if _EXISTING_TEXT is None:
+        _EXISTING_TEXT = "\n".join(
+            f"- {full_name}: {doc or '(no doc)'}"
+            for full_name, doc in get_existing_task_names_and_docs()
+        )
+    return _EXISTING_TEXT
+
+
+async def propose_new_task(
+    n: int = 1,
     model_name: str = "gpt-4.1-mini",
     temperature: float = 0.7,
     hint_brief: str | None = None,
-) -> Dict[str, str]:
+) -> List[Dict[str, str]]:
     """
-    Step 1: Propose a new task name and description from existing task list.
-    Returns dict with keys: task_name, group, task_description.
+    Step 1: Propose n new task names and descriptions from existing task list in a single LLM call.
+    Returns a list of dicts with keys: task_name, group, task_description.
     """
-    existing = get_existing_task_names_and_docs()
-    existing_text = "\n".join(
-        [f"- {full_name}: {doc or '(no doc)'}" for full_name, doc in existing]
-    )
-
     user_content = f"""Existing VIMA-Bench tasks (do not duplicate these names):
-{existing_text}
+{_existing_tasks_text()}
 """
     if hint_brief:
-        user_content += f"\nUser hint for the new task: {hint_brief}\n"
-    user_content += "\nPropose one new task (TASK_NAME, GROUP, TASK_DESCRIPTION):"
+        user_content += f"\nUser hint for the new tasks: {hint_brief}\n"
+    user_content += f"\nPropose N={n} new tasks as a JSON array of {{task_name, group, task_description}}:"
 
     llm = ChatOpenAI(model=model_name, temperature=temperature)
-    resp = llm.invoke(
+    resp = await llm.ainvoke(
         [{"role": "system", "content": PROMPT_STEP1_SYSTEM}, {"role": "user", "content": user_content}]
     )
     content = resp.content if isinstance(resp.content, str) else str(resp.content)
 
-    # Parse TASK_NAME:, GROUP:, TASK_DESCRIPTION:
-    task_name = ""
-    group = "instruction_following"
-    task_description = ""
-    for line in content.strip().split("\n"):
-        line = line.strip()
-        if line.upper().startswith("TASK_NAME:"):
-            task_name = line.split(":", 1)[1].strip()
-        elif line.upper().startswith("GROUP:"):
-            group = line.split(":", 1)[1].strip()
-        elif line.upper().startswith("TASK_DESCRIPTION:"):
-            task_description = line.split(":", 1)[1].strip()
-
-    if not task_name:
-        task_name = "generated_task"
-    if not task_description:
-        task_description = content[:200]
-
-    return {"task_name": task_name, "group": group, "task_description": task_description}
+    return _parse_proposals(content)[:n]
 
 
 # ---------- Step 2: Generate code (with API reference) ----------
 
+@functools.lru_cache(maxsize=4)
 def _system_prompt_step2(api_reference: str) -> str:
+    """
+    Fully static system message (API reference + skeleton + output rules).
+    Nothing per-candidate goes in here, so the prefix stays byte-identical across
+    calls and is eligible for OpenAI's automatic prompt caching.
+    """
     skeleton = """
 ```python
 class TEMPLATE_Task(BaseTask):
@@ -151,7 +187,7 @@ You are also given example task implementations from VIMA-Bench, and the followi
 {skeleton}
 
 Goal:
-- Implement a NEW task class that matches the given task name and description.
+- For EACH task listed by the user, implement a NEW task class that matches its task name and description.
 - Subclass BaseTask (or a specialized base like RotateTheObjBase, SweepObjectsToZoneBase if appropriate).
 - Define class attribute task_name = "<task_name>" (snake_case string).
 - Implement __init__(...) calling super().__init__(prompt_template=..., task_meta=..., placeholder_expression=..., oracle_max_steps=...).
@@ -161,9 +197,10 @@ Goal:
 - Use only ObjPedia.XXX and TexturePedia.XXX entries listed above; do not invent new ones.
 
 Constraints:
-- Output ONLY a Python code block (```python ... ```) containing the class definition.
-- No explanations outside the code block.
-- First line of the code can be a comment: # group: <group_name>
+- For each task i (1-based, in the order given), output a sentinel line `# === TASK <i> ===` followed by ONE Python code block (```python ... ```) containing that task's class definition.
+- Each code block must be self-contained (its own imports); do not share code between blocks.
+- No explanations outside the code blocks.
+- First line of each code block can be a comment: # group: <group_name>
 """
 
 
@@ -180,84 +217,474 @@ def _build_documents(task_docs: List[TaskDoc]) -> List[Document]:
                     "task_name": td.task_name,
                     "class_name": td.class_name,
                     "module": td.module,
+                    "parent_id": td.parent_id or td.id,
+                    "chunk_index": td.chunk_index,
                 },
             )
         )
     return docs
 
 
-def build_retriever(k: int = 5):
-    """Build a FAISS retriever over builtin + generated tasks. k is the number of docs to retrieve."""
+EMBEDDING_MODEL = "text-embedding-3-small"
+# HNSW graph settings for the task index (see _build_hnsw_store).
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+# Everything besides the docs that determines the saved index; part of the cache key.
+_INDEX_SETTINGS = f"{EMBEDDING_MODEL}\0hnsw-ip\0{HNSW_M}\0{HNSW_EF_CONSTRUCTION}\0{HNSW_EF_SEARCH}"
+
+
+def _task_docs_hash(task_docs: List[TaskDoc]) -> str:
+    """Hash of all task docs and index settings; the FAISS index only needs rebuilding when it changes."""
+    h = hashlib.sha256(_INDEX_SETTINGS.encode("utf-8") + b"\0")
+    for doc_id, text in sorted((td.id, td.text) for td in task_docs):
+        h.update(doc_id.encode("utf-8"))
+        h.update(b"\0")
+        h.update(text.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()[:16]
+
+
+def _gc_stale_caches(index_key: str) -> None:
+    """Remove cached indexes and retrieval results built from older task doc sets."""
+    if os.path.isdir(CACHE_DIR):
+        for name in os.listdir(CACHE_DIR):
+            if name.startswith("faiss_") and name != f"faiss_{index_key}":
+                shutil.rmtree(os.path.join(CACHE_DIR, name), ignore_errors=True)
+    retrieval_dir = os.path.join(CACHE_DIR, "retrieval")
+    if os.path.isdir(retrieval_dir):
+        for name in os.listdir(retrieval_dir):
+            if name != index_key:
+                shutil.rmtree(os.path.join(retrieval_dir, name), ignore_errors=True)
+
+
+class CachedRetriever:
+    """
+    MMR top-k retriever over a FAISS store that caches results per brief on disk.
+
+    Results are stored as doc ids + scores under VIMA_Gen/.cache/retrieval/<index_key>/
+    and rebuilt from the in-memory Document table on a hit, so a repeated brief
+    costs no embedding call. Cache misses in a batch share one embedding request.
+    """
+
+    def __init__(
+        self,
+        vectorstore: FAISS,
+        embeddings: OpenAIEmbeddings,
+        docs: List[Document],
+        index_key: str,
+        k: int = 5,
+    ):
+        self.vectorstore = vectorstore
+        self.embeddings = embeddings
+        self.k = k
+        self.fetch_k = 4 * k
+        self._docs_by_id = {d.metadata["id"]: d for d in docs}
+        self._cache_dir = os.path.join(CACHE_DIR, "retrieval", index_key)
+
+    def _cache_path(self, brief: str) -> str:
+        key = hashlib.sha256(f"mmr\0{self.k}\0{brief}".encode("utf-8")).hexdigest()
+        return os.path.join(self._cache_dir, f"{key}.json")
+
+    def _load_cached(self, brief: str) -> Optional[List[Document]]:
+        try:
+            with open(self._cache_path(brief), "r", encoding="utf-8") as f:
+                hits = json.load(f)
+            return [self._docs_by_id[h["id"]] for h in hits]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _search_and_store(self, brief: str, vector: List[float]) -> List[Document]:
+        hits = self.vectorstore.max_marginal_relevance_search_with_score_by_vector(
+            vector, k=self.k, fetch_k=self.fetch_k
+        )
+        records = [{"id": d.metadata["id"], "score": float(score)} for d, score in hits]
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            with open(self._cache_path(brief), "w", encoding="utf-8") as f:
+                json.dump(records, f)
+        except OSError:
+            pass
+        return [d for d, _ in hits]
+
+    async def aget_relevant_documents_batch(self, briefs: List[str]) -> List[List[Document]]:
+        results = [self._load_cached(b) for b in briefs]
+        misses = [i for i, r in enumerate(results) if r is None]
+        if misses:
+            vectors = await self.embeddings.aembed_documents([briefs[i] for i in misses])
+            for i, vector in zip(misses, vectors):
+                results[i] = self._search_and_store(briefs[i], vector)
+        return results
+
+
+def _build_hnsw_store(docs: List[Document], embeddings: OpenAIEmbeddings) -> FAISS:
+    """
+    Embed docs and index them in an HNSW graph (inner product on L2-normalized
+    vectors, i.e. cosine), so lookups stay sub-linear as generated tasks accumulate.
+    OpenAI embeddings are unit-length, so queries need no extra normalization.
+    """
+    vs = FAISS.from_documents(
+        docs, embedding=embeddings, distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+    )
+    vectors = vs.index.reconstruct_n(0, vs.index.ntotal)
+    faiss.normalize_L2(vectors)
+    index = faiss.IndexHNSWFlat(vectors.shape[1], HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    index.hnsw.efSearch = HNSW_EF_SEARCH
+    index.add(vectors)
+    vs.index = index
+    return vs
+
+
+def build_retriever(k: int = 5) -> CachedRetriever:
+    """
+    Build a FAISS retriever over builtin + generated tasks. k is the number of docs to retrieve.
+    The index is cached under VIMA_Gen/.cache/faiss_<hash>/ and only re-embedded when the docs change.
+    """
     task_docs = load_all_task_docs()
     docs = _build_documents(task_docs)
-    embeddings = OpenAIEmbeddings()
-    vs = FAISS.from_documents(docs, embedding=embeddings)
-    return vs.as_retriever(search_kwargs={"k": k})
+    embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL)
+    index_key = _task_docs_hash(task_docs)
+    cache_path = os.path.join(CACHE_DIR, f"faiss_{index_key}")
+    vs = None
+    if os.path.isdir(cache_path):
+        try:
+            vs = FAISS.load_local(
+                cache_path,
+                embeddings,
+                allow_dangerous_deserialization=True,
+                distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+            )
+        except Exception:
+            # Unreadable cache (e.g. left by an older version): rebuild it.
+            shutil.rmtree(cache_path, ignore_errors=True)
+    if vs is None:
+        vs = _build_hnsw_store(docs, embeddings)
+        _save_index(vs, cache_path)
+        _gc_stale_caches(index_key)
+    return CachedRetriever(vs, embeddings, docs, index_key=index_key, k=k)
 
 
-def generate_new_task_code(
-    task_name: str,
-    task_description: str,
-    group: str,
-    retriever,
-    api_reference: str,
-    past_failures_text: str = "",
-    model_name: str = "gpt-4.1-mini",
-    temperature: float = 0.7,
-) -> str:
+def _save_index(vs: FAISS, cache_path: str) -> None:
     """
-    Step 2: Generate Python code for the task given (task_name, task_description, group).
-    Uses api_reference so the model only uses allowed imports and tools.
-    past_failures_text: 历史未通过代码与报错，注入提示词以规避相似错误。
+    Save into a temp directory and rename it into place, so an interrupted save
+    never leaves a half-written faiss_<hash>/ that later runs would try to load.
     """
-    brief = f"task_name: {task_name}\ngroup: {group}\ntask_description: {task_description}"
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{cache_path}.tmp{os.getpid()}"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    try:
+        vs.save_local(tmp_path)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # Another process saved the same index first; keep theirs.
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+_TASK_SENTINEL_RE = re.compile(r"^#\s*===\s*TASK\s+(\d+)\s*===\s*$", re.MULTILINE)
+_FENCE_LINE_RE = re.compile(r"^[ \t]*```([^\n]*)$", re.MULTILINE)
+
+
+def _format_brief(task: Dict[str, str]) -> str:
+    return (
+        f"task_name: {task['task_name']}\n"
+        f"group: {task['group']}\n"
+        f"task_description: {task['task_description']}"
+    )
+
+
+def _scan_code_blocks(text: str) -> List[tuple[int, int, str, str]]:
+    """
+    Single linear scan over fences that start a line (inline ``` in prose is ignored).
+    Returns (open_pos, close_pos, header, body) for every closed block, in order.
+    """
+    blocks: List[tuple[int, int, str, str]] = []
+    fences = _FENCE_LINE_RE.finditer(text)
+    for opening in fences:
+        closing = next(fences, None)
+        if closing is None:
+            break
+        header = opening.group(1).strip().lower()
+        blocks.append((opening.start(), closing.start(), header, text[opening.end() + 1 : closing.start()]))
+    return blocks
 
-    related_docs = retriever.get_relevant_documents(brief)
-    context_snippets = []
-    for d in related_docs:
-        tn = d.metadata.get("task_name")
-        cn = d.metadata.get("class_name")
-        gr = d.metadata.get("group")
-        header = f"=== Example: {gr}/{tn} ({cn}) ==="
-        context_snippets.append(header + "\n" + d.page_content)
-    context = "\n\n".join(context_snippets)
 
+def _pick_code(bodies: List[tuple[str, str]]) -> Optional[str]:
+    """Longest ```python block (the real code rather than a preamble snippet), else the longest block."""
+    if not bodies:
+        return None
+    python_bodies = [body for header, body in bodies if header.startswith("python")]
+    return max(python_bodies or [body for _, body in bodies], key=len).strip()
+
+
+def _extract_code_block(text: str) -> Optional[str]:
+    return _pick_code([(header, body) for _, _, header, body in _scan_code_blocks(text)])
+
+
+def _split_task_codes(content: str, n: int) -> List[Optional[str]]:
+    """
+    Assign the code blocks of a batched Step-2 reply to n tasks (None if missing).
+    A block belongs to the `# === TASK <i> ===` sentinel above it, or to the one on
+    its own first lines; without any sentinel, python blocks are taken in order.
+    """
+    blocks = _scan_code_blocks(content)
+    sentinels = list(_TASK_SENTINEL_RE.finditer(content))
+    if not sentinels:
+        if n == 1:
+            return [_extract_code_block(content)]
+        python_blocks = [body for _, _, header, body in blocks if header.startswith("python")]
+        codes: List[Optional[str]] = [body.strip() for body in python_blocks[:n]]
+        return codes + [None] * (n - len(codes))
+
+    per_task: List[List[tuple[str, str]]] = [[] for _ in range(n)]
+    current: Optional[int] = None
+    s = 0
+    for open_pos, close_pos, header, body in blocks:
+        while s < len(sentinels) and sentinels[s].start() < open_pos:
+            current = int(sentinels[s].group(1)) - 1
+            s += 1
+        if s < len(sentinels) and sentinels[s].start() < close_pos:
+            # Sentinel written inside the block: it names this block's task.
+            current = int(sentinels[s].group(1)) - 1
+            while s < len(sentinels) and sentinels[s].start() < close_pos:
+                s += 1
+            body = _TASK_SENTINEL_RE.sub("", body)
+        if current is not None and 0 <= current < n:
+            per_task[current].append((header, body))
+    return [_pick_code(bodies) for bodies in per_task]
+
+
+# Context windows of the models we use; unknown models fall back to the default.
+_MODEL_CONTEXT_TOKENS = {
+    "gpt-4.1": 1_047_576,
+    "gpt-4.1-mini": 1_047_576,
+    "gpt-4.1-nano": 1_047_576,
+    "gpt-4o": 128_000,
+    "gpt-4o-mini": 128_000,
+}
+_DEFAULT_CONTEXT_TOKENS = 128_000
+# Output tokens reserved for each task's code in a Step-2 batch.
+OUTPUT_TOKENS_PER_TASK = 4_000
+
+_FAILURE_HEADER_RE = re.compile(r"^--- Failure #\d+", re.MULTILINE)
+
+
+@functools.lru_cache(maxsize=8)
+def _get_encoding(model_name: str) -> tiktoken.Encoding:
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def _drop_oldest_failure(past_failures_text: str) -> str:
+    """Remove the oldest `--- Failure #i ---` entry; returns "" once none would be left."""
+    starts = [m.start() for m in _FAILURE_HEADER_RE.finditer(past_failures_text)]
+    if len(starts) <= 1:
+        return ""
+    return past_failures_text[: starts[0]] + past_failures_text[starts[1] :]
+
+
+def _build_step2_user_prompt(
+    past_failures_text: str,
+    context_snippets: List[str],
+    briefs: List[str],
+) -> str:
+    # Stable-to-variable ordering: past failures (same for the whole run) first,
+    # then retrieved examples, then the per-batch task briefs last.
     failures_block = ""
     if past_failures_text:
-        failures_block = f"""
-{past_failures_text}
+        failures_block = f"""{past_failures_text}
 
 Avoid the above errors in your new code.
 
 """
-
-    user_prompt = f"""New task to implement:
-{brief}
-{failures_block}
-Example tasks for reference:
+    context = "\n\n".join(context_snippets)
+    tasks_text = "\n\n".join(f"# === TASK {i} ===\n{brief}" for i, brief in enumerate(briefs, 1))
+    return f"""{failures_block}Example tasks for reference:
 {context}
 
-Generate the Python class for this task. Use ONLY the imports and tools from the API reference. Output only a ```python ... ``` block.
+New tasks to implement (N={len(briefs)}):
+{tasks_text}
+
+Generate one Python class per task. Use ONLY the imports and tools from the API reference. For each task output its `# === TASK <i> ===` line followed by a ```python ... ``` block.
 """.strip()
 
+
+def _fit_step2_user_prompt(
+    system_prompt: str,
+    past_failures_text: str,
+    context_snippets: List[str],
+    briefs: List[str],
+    model_name: str,
+) -> str:
+    """
+    Build the Step-2 user prompt within the model's context window, counted locally
+    with tiktoken. Over budget, drop the oldest past failures first, then the
+    lowest-ranked example snippets, instead of letting the server truncate.
+    """
+    enc = _get_encoding(model_name)
+    budget = (
+        _MODEL_CONTEXT_TOKENS.get(model_name, _DEFAULT_CONTEXT_TOKENS)
+        - OUTPUT_TOKENS_PER_TASK * len(briefs)
+        - len(enc.encode(system_prompt))
+    )
+    snippets = list(context_snippets)
+    while True:
+        user_prompt = _build_step2_user_prompt(past_failures_text, snippets, briefs)
+        if len(enc.encode(user_prompt)) <= budget:
+            return user_prompt
+        if past_failures_text:
+            past_failures_text = _drop_oldest_failure(past_failures_text)
+        elif snippets:
+            snippets.pop()
+        else:
+            return user_prompt
+
+
+def _content_text(content: Any) -> str:
+    """Text of a message/chunk content, which is either a str or a list of content parts."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return "".join(c.get("text", "") for c in content if isinstance(c, dict))
+    return ""
+
+
+def _last_block_closed(text: str, n_blocks: int) -> bool:
+    """
+    True once the code block of the last task has closed: the block after the
+    `# === TASK <n_blocks> ===` sentinel (or the one that sentinel opens, if it is
+    the block's first line). Only fences that start a line count. Without any
+    sentinel, fall back to n_blocks closed ```python blocks, the ones
+    _split_task_codes would pick.
+    """
+    sentinel = next(
+        (m for m in _TASK_SENTINEL_RE.finditer(text) if int(m.group(1)) == n_blocks), None
+    )
+    if sentinel is None:
+        if _TASK_SENTINEL_RE.search(text):
+            return False
+        python_blocks = [b for b in _scan_code_blocks(text) if b[2].startswith("python")]
+        return len(python_blocks) >= n_blocks
+    inside_block = len(_FENCE_LINE_RE.findall(text, 0, sentinel.start())) % 2 == 1
+    return len(_FENCE_LINE_RE.findall(text, sentinel.end())) >= (1 if inside_block else 2)
+
+
+async def _astream_code_blocks(llm: ChatOpenAI, messages: List[Dict[str, str]], n_blocks: int) -> str:
+    """
+    Stream the reply and stop as soon as the last task's code block has closed,
+    so trailing commentary is neither waited for nor generated.
+    """
+    text = ""
+    stream = llm.astream(messages)
+    try:
+        async for chunk in stream:
+            piece = _content_text(chunk.content)
+            text += piece
+            # A block can only close on a chunk carrying a backtick.
+            if "`" in piece and _last_block_closed(text, n_blocks):
+                break
+    finally:
+        await stream.aclose()
+    return text
+
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def _join_overlapping(chunks: List[str]) -> str:
+    """Concatenate consecutive chunks, dropping the text each one repeats from its predecessor."""
+    merged = chunks[0]
+    for chunk in chunks[1:]:
+        overlap = next(
+            (n for n in range(min(len(chunk), len(merged), CHUNK_OVERLAP), 0, -1) if merged.endswith(chunk[:n])),
+            0,
+        )
+        merged += ("" if overlap else "\n") + chunk[overlap:]
+    return merged
+
+
+def _merge_chunks_by_parent(related_docs: List[Document]) -> List[str]:
+    """
+    Group retrieved chunks by their parent task (in order of first hit), dedupe them,
+    and stitch each parent's chunks back together in source order as one snippet.
+    Chunks whose whitespace-normalized content was already seen (e.g. the same
+    boilerplate in two tasks) are dropped so they don't cost prompt tokens twice.
+    """
+    seen = set()
+    by_parent: Dict[str, Dict[int, Document]] = {}
+    for d in related_docs:
+        h = hashlib.sha1(_WHITESPACE_RE.sub(" ", d.page_content).strip().encode("utf-8")).digest()
+        if h in seen:
+            continue
+        seen.add(h)
+        parent_id = d.metadata.get("parent_id") or d.metadata.get("id")
+        by_parent.setdefault(parent_id, {})[d.metadata.get("chunk_index", 0)] = d
+
+    snippets = []
+    for chunks in by_parent.values():
+        first = next(iter(chunks.values()))
+        tn = first.metadata.get("task_name")
+        cn = first.metadata.get("class_name")
+        gr = first.metadata.get("group")
+        header = f"=== Example: {gr}/{tn} ({cn}) ==="
+
+        parts, run, prev = [], [], None
+        for idx in sorted(chunks):
+            if prev is not None and idx != prev + 1:
+                parts.append(_join_overlapping(run))
+                run = []
+            run.append(chunks[idx].page_content)
+            prev = idx
+        parts.append(_join_overlapping(run))
+        snippets.append(header + "\n" + "\n# ...\n".join(parts))
+    return snippets
+
+
+async def generate_new_task_code(
+    tasks: List[Dict[str, str]],
+    retriever,
+    api_reference: str,
+    past_failures_text: str = "",
+    model_name: str = "gpt-4.1-mini",
+    temperature: float = 0.7,
+) -> List[Optional[str]]:
+    """
+    Step 2: Generate Python code for a batch of tasks (dicts with task_name, task_description, group)
+    in a single LLM call. Returns one code string per task, None where the reply had no code block.
+    Uses api_reference so the model only uses allowed imports and tools.
+    past_failures_text: 历史未通过代码与报错，注入提示词以规避相似错误。
+    """
+    if not tasks:
+        return []
+    briefs = [_format_brief(t) for t in tasks]
+
+    # Retrieve examples per task and share the merged set across the batch.
+    related_docs = [
+        d for docs in await retriever.aget_relevant_documents_batch(briefs) for d in docs
+    ]
+    context_snippets = _merge_chunks_by_parent(related_docs)
+    if not context_snippets:
+        # Without example tasks the model has nothing to follow; skip the LLM call.
+        raise ValueError("检索上下文为空（没有可参考的示例任务），跳过 Step 2。")
+
+    system_prompt = _system_prompt_step2(api_reference)
+    user_prompt = _fit_step2_user_prompt(
+        system_prompt, past_failures_text, context_snippets, briefs, model_name
+    )
+
     llm = ChatOpenAI(model=model_name, temperature=temperature)
-    resp = llm.invoke(
+    content = await _astream_code_blocks(
+        llm,
         [
-            {"role": "system", "content": _system_prompt_step2(api_reference)},
+            {"role": "system", "content": system_prompt},
             {"role": "user", "content": user_prompt},
-        ]
+        ],
+        n_blocks=len(tasks),
     )
-    content = resp.content if isinstance(resp.content, str) else "".join(
-        [c.get("text", "") for c in (resp.content if isinstance(resp.content, list) else []) if isinstance(c, dict)]
-    )
-    if not content:
-        content = str(resp.content)
 
-    code_match = re.search(r"```python(.*?)```", content, re.DOTALL | re.IGNORECASE)
-    if not code_match:
-        code_match = re.search(r"```(.*?)```", content, re.DOTALL)
-    if not code_match:
+    codes = _split_task_codes(content, len(tasks))
+    if all(code is None for code in codes):
         raise ValueError("LLM 没有返回可解析的 code block。\n完整回复：\n" + content)
-
-    code = code_match.group(1).strip()
-    return code
+    return codes
@@ -1,21 +1,38 @@
 from __future__ import annotations
 
+import functools
 import inspect
 import os
+import pickle
 import re
-import sys
 from dataclasses import dataclass
-from typing import List, Optional
+from typing import List, Optional, Tuple
+
+from _paths import ensure_on_path
 
-# Ensure project root (containing vima_bench) is on sys.path when running
-# scripts from inside VIMA_Gen directly.
 _THIS_DIR = os.path.dirname(os.path.abspath(__file__))
-_ROOT_DIR = os.path.dirname(_THIS_DIR)
-if _ROOT_DIR not in sys.path:
-    sys.path.insert(0, _ROOT_DIR)
 
+# On-disk caches (FAISS index etc.) live under VIMA_Gen/.cache.
+CACHE_DIR = os.path.join(_THIS_DIR, ".cache")
+
+ensure_on_path()
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+import vima_bench.tasks as _vima_tasks
 from vima_bench.tasks import ALL_TASKS as _ALL_TASKS
 
+_BUILTIN_CACHE_PATH = os.path.join(CACHE_DIR, "builtin_tasks.pkl")
+
+# Builtin task sources are split into ~40-line overlapping chunks, preferring
+# class / method boundaries, so retrieval returns the relevant part of a task.
+CHUNK_OVERLAP = 200
+_SOURCE_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=1500,
+    chunk_overlap=CHUNK_OVERLAP,
+    separators=["\nclass ", "\n    def ", "\ndef ", "\n\n", "\n", " ", ""],
+)
+
 
 @dataclass
 class TaskDoc:
@@ -28,6 +45,9 @@ class TaskDoc:
     class_name: Optional[str]
     module: Optional[str]
     text: str
+    # Chunks of one task share parent_id (the unchunked doc id); chunk_index orders them.
+    parent_id: Optional[str] = None
+    chunk_index: int = 0
 
 
 def _split_full_task_name(full_name: str) -> tuple[str, str]:
@@ -39,8 +59,46 @@ def _split_full_task_name(full_name: str) -> tuple[str, str]:
     return group, task_name
 
 
+def _builtin_sources_mtime() -> float:
+    """Latest mtime over the vima_bench.tasks sources and this module (which shapes the docs)."""
+    mtimes = [os.path.getmtime(__file__)]
+    tasks_dir = os.path.dirname(os.path.abspath(_vima_tasks.__file__))
+    for dirpath, _, filenames in os.walk(tasks_dir):
+        for fname in filenames:
+            if fname.endswith(".py"):
+                mtimes.append(os.path.getmtime(os.path.join(dirpath, fname)))
+    return max(mtimes)
+
+
 def load_builtin_task_docs() -> List[TaskDoc]:
-    """Collect the 17 built-in VIMA tasks as text documents."""
+    """
+    Collect the 17 built-in VIMA tasks as text documents.
+
+    The result is pickled to VIMA_Gen/.cache/builtin_tasks.pkl and reused while
+    no vima_bench.tasks source file has changed, skipping inspect.getsource.
+    """
+    mtime = _builtin_sources_mtime()
+    try:
+        with open(_BUILTIN_CACHE_PATH, "rb") as f:
+            cached_mtime, cached_docs = pickle.load(f)
+        if cached_mtime == mtime:
+            return cached_docs
+    except Exception:
+        # Missing or unreadable cache: rebuild below.
+        pass
+
+    docs = _build_builtin_task_docs()
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(_BUILTIN_CACHE_PATH, "wb") as f:
+            pickle.dump((mtime, docs), f)
+    except OSError:
+        pass
+    return docs
+
+
+def _build_builtin_task_docs() -> List[TaskDoc]:
+    """One TaskDoc per source chunk, with id builtin::<group>/<task_name>#<i>."""
     docs: List[TaskDoc] = []
     for full_name, cls in _ALL_TASKS.items():
         group, task_name = _split_full_task_name(full_name)
@@ -65,43 +123,51 @@ def load_builtin_task_docs() -> List[TaskDoc]:
             "Source code:",
             source,
         ]
-        docs.append(
-            TaskDoc(
-                id=f"builtin::{group}/{task_name}",
-                origin="builtin",
-                group=group,
-                task_name=task_name,
-                class_name=cls.__name__,
-                module=module_name,
-                text="\n".join(text_parts),
+        parent_id = f"builtin::{group}/{task_name}"
+        for i, chunk in enumerate(_SOURCE_SPLITTER.split_text("\n".join(text_parts))):
+            docs.append(
+                TaskDoc(
+                    id=f"{parent_id}#{i}",
+                    origin="builtin",
+                    group=group,
+                    task_name=task_name,
+                    class_name=cls.__name__,
+                    module=module_name,
+                    text=chunk,
+                    parent_id=parent_id,
+                    chunk_index=i,
+                )
             )
-        )
     return docs
 
 
-def _infer_group_from_text(text: str) -> str:
-    """Best-effort guess of a group name from a generated file's contents."""
-    # Allow a convention at the top of generated files:
-    #   # group: require_memory
-    m = re.search(r"^#\s*group\s*:\s*([A-Za-z0-9_\/\-]+)", text, flags=re.MULTILINE)
-    if m:
-        return m.group(1).strip()
-    # Fallback generic label.
-    return "generated"
-
+# Single pass over a generated file for the three fields we need:
+#   # group: require_memory          (optional convention at the top of the file)
+#   task_name = "..."
+#   class Foo(
+_GENERATED_FIELDS_RE = re.compile(
+    r"^#\s*group\s*:\s*(?P<group>[A-Za-z0-9_\/\-]+)"
+    r"|task_name\s*=\s*[\"'](?P<tname>[^\"']+)[\"']"
+    r"|class\s+(?P<cname>[A-Za-z_][A-Za-z0-9_]*)\s*\(",
+    re.MULTILINE,
+)
 
-def _infer_task_name_from_text(path: str, text: str) -> str:
-    """Try to infer task_name from code, fall back to filename stem."""
-    m = re.search(r'task_name\s*=\s*["\']([^"\']+)["\']', text)
-    if m:
-        return m.group(1).strip()
-    # Fallback to filename without extension.
-    return os.path.splitext(os.path.basename(path))[0]
 
-
-def _infer_class_name_from_text(text: str) -> Optional[str]:
-    m = re.search(r"class\s+([A-Za-z_][A-Za-z0-9_]*)\s*\(", text)
-    return m.group(1) if m else None
+def _scan_generated_text(path: str, text: str) -> tuple[str, str, Optional[str]]:
+    """
+    Best-effort (group, task_name, class_name) of a generated file, taking the first
+    occurrence of each. group falls back to "generated", task_name to the filename stem.
+    """
+    found: dict = {}
+    for m in _GENERATED_FIELDS_RE.finditer(text):
+        key = m.lastgroup
+        if key not in found:
+            found[key] = m.group(key).strip()
+            if len(found) == 3:
+                break
+    group = found.get("group", "generated")
+    task_name = found.get("tname") or os.path.splitext(os.path.basename(path))[0]
+    return group, task_name, found.get("cname")
 
 
 def load_generated_task_docs(
@@ -119,20 +185,21 @@ def load_generated_task_docs(
     if not os.path.isdir(gen_dir):
         return []
 
+    with os.scandir(gen_dir) as it:
+        entries = sorted(
+            (e for e in it if e.name.endswith(".py") and e.is_file()), key=lambda e: e.name
+        )
+
     docs: List[TaskDoc] = []
-    for fname in sorted(os.listdir(gen_dir)):
-        if not fname.endswith(".py"):
-            continue
-        path = os.path.join(gen_dir, fname)
+    for entry in entries:
+        fname, path = entry.name, entry.path
         try:
             with open(path, "r", encoding="utf-8") as f:
                 text = f.read()
         except OSError:
             continue
 
-        group = _infer_group_from_text(text)
-        task_name = _infer_task_name_from_text(path, text)
-        class_name = _infer_class_name_from_text(text)
+        group, task_name, class_name = _scan_generated_text(path, text)
         docs.append(
             TaskDoc(
                 id=f"generated::{fname}",
@@ -142,6 +209,7 @@ def load_generated_task_docs(
                 class_name=class_name,
                 module=None,
                 text=text,
+                parent_id=f"generated::{fname}",
             )
         )
     return docs
@@ -152,12 +220,13 @@ def load_all_task_docs() -> List[TaskDoc]:
     return load_builtin_task_docs() + load_generated_task_docs()
 
 
-def get_existing_task_names_and_docs() -> List[tuple[str, str]]:
-    """Return [(full_name, first_line_of_doc), ...] for all builtin tasks (for step-1 prompt)."""
+@functools.lru_cache(maxsize=1)
+def get_existing_task_names_and_docs() -> Tuple[tuple[str, str], ...]:
+    """Return ((full_name, first_line_of_doc), ...) for all builtin tasks (for step-1 prompt). Cached."""
     result: List[tuple[str, str]] = []
     for full_name, cls in _ALL_TASKS.items():
         doc = (inspect.getdoc(cls) or "").strip()
         first_line = doc.split("\n")[0] if doc else ""
         result.append((full_name, first_line))
-    return result
+    return tuple(result)
 
@@ -5,83 +5,228 @@ Verify generated task code in an environment that mirrors vima_bench/tasks:
 """
 from __future__ import annotations
 
+import ast
+import atexit
+import concurrent.futures as cf
+import functools
+import itertools
+import multiprocessing
 import os
 import re
 import sys
-from typing import Optional, Type
+import types
+from typing import TYPE_CHECKING, List, Optional, Type
 
 import numpy as np
 
-# 模拟“放在 tasks 文件夹中”的环境：保证项目根在 sys.path，使
-# from vima_bench.tasks... 能正确解析，不注入任何 shim 模块。
-_THIS_DIR = os.path.dirname(os.path.abspath(__file__))
-_ROOT_DIR = os.path.dirname(_THIS_DIR)
-if _ROOT_DIR not in sys.path:
-    sys.path.insert(0, _ROOT_DIR)
+from _paths import ensure_on_path
+from action_clip import make_action_clipper
 
-from vima_bench.env import VIMAEnvBase
-from vima_bench.tasks.task_suite.base import BaseTask
 
+if TYPE_CHECKING:
+    from vima_bench.env import VIMAEnvBase
+    from vima_bench.tasks.task_suite.base import BaseTask
 
-def _extract_class_name(code: str) -> str:
-    m = re.search(r"class\s+([A-Za-z_][A-Za-z0-9_]*)\s*\(", code)
-    if not m:
-        raise ValueError("无法从生成代码中找到 class 定义。")
-    return m.group(1)
+
+@functools.lru_cache(maxsize=None)
+def _imports():
+    """
+    延迟导入 vima_bench（会连带 PyBullet 与资源发现），只在真正 exec / 建 env 时导入一次；
+    只用 quick_reject / extract_task_name_literal 的调用方不付这部分开销。
+    """
+    # 模拟“放在 tasks 文件夹中”的环境：项目根在 sys.path，不注入任何 shim 模块
+    ensure_on_path()
+    from vima_bench.env import VIMAEnvBase
+    from vima_bench.tasks.task_suite.base import BaseTask
+
+    return VIMAEnvBase, BaseTask
+
+
+_CLASS_RE = re.compile(r"class\s+([A-Za-z_][A-Za-z0-9_]*)\s*\(")
+_TASK_NAME_RE = re.compile(r'task_name\s*=\s*["\']([^"\']+)["\']')
 
 
 def extract_task_name_literal(code: str) -> Optional[str]:
-    m = re.search(r'task_name\s*=\s*["\']([^"\']+)["\']', code)
+    m = _TASK_NAME_RE.search(code)
     return m.group(1) if m else None
 
 
+# 结构检查关注的三个片段，一次扫描全部找出；在 bytes 上匹配（片段均为 ASCII）
+_ORACLE_DEF = b"def oracle("
+_GOALS_APPEND = b"self.goals.append("
+_ALL_GOALS_COPY = b"self._all_goals = self.goals.copy()"
+_STRUCT_RE = re.compile(
+    b"|".join(re.escape(needle) for needle in (_ORACLE_DEF, _GOALS_APPEND, _ALL_GOALS_COPY))
+)
+
+
 def _structural_checks(code: str) -> tuple[bool, str]:
-    """快速静态检查，尽早过滤明显结构错误。"""
+    """快速静态检查，尽早过滤明显结构错误（单次扫描源码）。"""
+    # 非 ASCII 字符替换为 "?"，不影响对纯 ASCII 片段的匹配
+    buf = code.encode("ascii", "replace")
+    found = set()
+    for m in _STRUCT_RE.finditer(buf):
+        found.add(m.group(0))
+        if len(found) == 3:
+            break
     # 不允许自定义 oracle，避免破坏 BaseTask.oracle 的逻辑
-    if "def oracle(" in code:
+    if _ORACLE_DEF in found:
         return False, "Should not override oracle(); inherit BaseTask.oracle instead."
     # 必须有 goals scaffold
-    if "self.goals.append(" not in code:
+    if _GOALS_APPEND not in found:
         return False, "No self.goals.append(...) found in reset(); oracle has no goals to follow."
-    if "self._all_goals = self.goals.copy()" not in code:
+    if _ALL_GOALS_COPY not in found:
         return False, "Missing self._all_goals = self.goals.copy() after setting goals."
     return True, ""
 
 
+def quick_reject(code: str) -> Optional[str]:
+    """
+    纯字符串 / 正则的预检（不 exec、不碰 PyBullet），供批量驱动先行过滤候选。
+    返回第一个失败原因；通过则返回 None。
+    """
+    ok_struct, struct_msg = _structural_checks(code)
+    if not ok_struct:
+        return struct_msg
+    if not _CLASS_RE.search(code):
+        return "无法从生成代码中找到 class 定义。"
+    return None
+
+
+@functools.lru_cache(maxsize=128)
+def _compile_cached(code: str) -> tuple[types.CodeType, tuple[str, ...]]:
+    """
+    只解析一次 AST：取出顶层 class 名，并直接编译同一棵树。
+    同一份代码重复验证（重试 / 不同 seed）时复用结果。
+    """
+    tree = ast.parse(code, filename="<gen_task>")
+    class_names = tuple(n.name for n in tree.body if isinstance(n, ast.ClassDef))
+    return compile(tree, "<gen_task>", "exec"), class_names
+
+
+_exec_counter = itertools.count()
+
+
 def load_task_class_from_code(code: str) -> Type[BaseTask]:
     """
     在“模拟 tasks 文件夹”的环境中 exec 代码并返回任务类。
+    文件中有多个 BaseTask 子类时（例如先定义辅助基类），返回最末端的那个。
     """
-    local_ns: dict = {"__builtins__": __builtins__}
-    exec(code, local_ns, local_ns)
+    code_obj, class_names = _compile_cached(code)
+    if not class_names:
+        raise ValueError("无法从生成代码中找到 class 定义。")
+    _, BaseTask = _imports()
+
+    # 每次 exec 使用独立的临时模块作为命名空间：类的 __module__ 有意义，
+    # 且执行期间可被 import 机制 / dataclasses 等按模块名找到；执行完即移出
+    # sys.modules，之后只由任务类的方法（__globals__）引用，不会跨验证累积。
+    mod_name = f"_vima_gen_task_{next(_exec_counter)}"
+    mod = types.ModuleType(mod_name)
+    sys.modules[mod_name] = mod
+    try:
+        exec(code_obj, mod.__dict__)
+    finally:
+        sys.modules.pop(mod_name, None)
+
+    task_classes = [
+        cls
+        for cls in (mod.__dict__.get(name) for name in class_names)
+        if isinstance(cls, type) and issubclass(cls, BaseTask)
+    ]
+    for TaskCls in task_classes:
+        if not any(other is not TaskCls and issubclass(other, TaskCls) for other in task_classes):
+            return TaskCls
+    raise TypeError(f"{class_names[0]} 没有继承 BaseTask")
+
+
+# 验证用 env 的配置；env 按 (modalities, hide_arm_rgb) 缓存，跨多次验证复用，
+# 避免每个候选都重新初始化 PyBullet 与加载资源。
+_ENV_MODALITIES = ("rgb", "segm")
+_ENV_HIDE_ARM_RGB = True
+_ENV_SEED = 42
+_ENV_CACHE: dict[tuple, VIMAEnvBase] = {}
+
+
+def _get_env(task_instance: BaseTask, reuse_env: bool, seed: int = _ENV_SEED) -> VIMAEnvBase:
+    """取缓存的 env 并切换到新任务；没有缓存（或不复用）时新建。"""
+    key = (_ENV_MODALITIES, _ENV_HIDE_ARM_RGB)
+    env = _ENV_CACHE.get(key) if reuse_env else None
+    if env is None:
+        VIMAEnvBase, _ = _imports()
+        env = VIMAEnvBase(
+            task=task_instance,
+            modalities=list(_ENV_MODALITIES),
+            seed=seed,
+            debug=False,
+            display_debug_window=False,
+            hide_arm_rgb=_ENV_HIDE_ARM_RGB,
+        )
+        if reuse_env:
+            _ENV_CACHE[key] = env
+    else:
+        try:
+            env.set_task(task_instance)
+            env.seed(seed)
+        except Exception:
+            # 切换到一半的 env 状态不可信：关闭并移出缓存，避免下一个候选复用
+            _release_env(env, reuse_env, broken=True)
+            raise
+    return env
+
 
-    cls_name = _extract_class_name(code)
-    TaskCls = local_ns.get(cls_name)
-    if TaskCls is None:
-        raise ValueError(f"在 exec 环境中找不到类 {cls_name}")
-    if not issubclass(TaskCls, BaseTask):
-        raise TypeError(f"{cls_name} 没有继承 BaseTask")
-    return TaskCls
+def _release_env(env: Optional[VIMAEnvBase], reuse_env: bool, broken: bool = False) -> None:
+    """复用模式下保留 env 供下次验证；不复用或运行出错（状态不可信）时关闭并移出缓存。"""
+    if env is None or (reuse_env and not broken):
+        return
+    for key in [k for k, cached in _ENV_CACHE.items() if cached is env]:
+        del _ENV_CACHE[key]
+    try:
+        env.close()
+    except Exception:
+        pass
+
+
+def close_cached_envs() -> None:
+    """关闭所有缓存的验证 env（进程退出时自动调用）。"""
+    for env in _ENV_CACHE.values():
+        try:
+            env.close()
+        except Exception:
+            pass
+    _ENV_CACHE.clear()
 
 
-def verify_task_code(code: str, verbose: bool = True) -> tuple[bool, Optional[int], Optional[str]]:
+atexit.register(close_cached_envs)
+
+
+def verify_task_code(
+    code: str,
+    verbose: bool = True,
+    debug: bool = False,
+    reuse_env: bool = True,
+    seed: int = _ENV_SEED,
+) -> tuple[bool, Optional[int], Optional[str]]:
     """
     三步验证：
     1. 语法/导入：exec 成功且得到继承 BaseTask 的类
     2. 运行时：构造实例 + env.reset() 成功
     3. Oracle：在 oracle_max_steps 内能完成且 info['success'] 为 True
 
+    debug=True 时在每个 oracle step 前额外渲染 true image 并打印 goals / mask 信息
+    （较慢，只在排查 oracle 问题时打开）。
+    reuse_env=True 时复用进程内缓存的 VIMAEnvBase（见 _get_env），验证结束不关闭。
+
     Returns:
         (success, failed_step, error_message)
         - success=True 时 failed_step 与 error_message 为 None
         - success=False 时 failed_step 为 1/2/3，error_message 为报错内容
     """
     # ---------- Step 1: 语法 / exec + 结构检查 ----------
-    ok_struct, struct_msg = _structural_checks(code)
-    if not ok_struct:
+    reject_msg = quick_reject(code)
+    if reject_msg is not None:
         if verbose:
-            print(f"[VERIFY][Step 1] 结构检查失败：{struct_msg}")
-        return False, 1, struct_msg
+            print(f"[VERIFY][Step 1] 结构检查失败：{reject_msg}")
+        return False, 1, reject_msg
     try:
         TaskCls = load_task_class_from_code(code)
         if verbose:
@@ -96,14 +241,7 @@ def verify_task_code(code: str, verbose: bool = True) -> tuple[bool, Optional[in
     env = None
     try:
         task_instance = TaskCls(debug=False)
-        env = VIMAEnvBase(
-            task=task_instance,
-            modalities=["rgb", "segm"],
-            seed=42,
-            debug=False,
-            display_debug_window=False,
-            hide_arm_rgb=True,
-        )
+        env = _get_env(task_instance, reuse_env, seed=seed)
         obs = env.reset()
         task = env.task
         # 额外结构检查：reset 后 goals 必须非空，_all_goals 已初始化
@@ -120,11 +258,7 @@ def verify_task_code(code: str, verbose: bool = True) -> tuple[bool, Optional[in
         err_msg = str(e)
         if verbose:
             print(f"[VERIFY][Step 2] 运行时（构造实例 / env.reset）失败：{err_msg}")
-        if env is not None:
-            try:
-                env.close()
-            except Exception:
-                pass
+        _release_env(env, reuse_env, broken=True)
         return False, 2, err_msg
 
     # ---------- Step 3: Oracle 完成度 ----------
@@ -136,51 +270,121 @@ def verify_task_code(code: str, verbose: bool = True) -> tuple[bool, Optional[in
                 f"task.oracle(env) 返回了 None！"
                 f"检查：goals={task.goals}, _all_goals={getattr(task, '_all_goals', 'NOT SET')}"
             )
-        success = False
-        info = {}
+        done = False
+        last_info: dict = {}
+        action_dict, clip_into = make_action_clipper(env.action_space)
+        max_steps = getattr(task, "oracle_max_steps", 10)
+
+        for step in range(max_steps):
+            if debug:
+                # DEBUG: inspect environment / masks before calling oracle
+                try:
+                    _, hmap, obj_mask = task.get_true_image(env)
+                    print("[DEBUG] goals:", task.goals)
+                    print("[DEBUG] obj_id_reverse_mapping keys:", list(env.obj_id_reverse_mapping.keys()))
+                    print("[DEBUG] obj_mask unique ids:", np.unique(obj_mask)[:20])
+                    print("[DEBUG] obj_mask nonzero count:", np.count_nonzero(obj_mask))
+                except Exception as _e:
+                    print("[DEBUG] get_true_image() failed:", _e)
 
-        for step in range(getattr(task, "oracle_max_steps", 10)):
-            # DEBUG: inspect environment / masks before calling oracle
-            try:
-                _, hmap, obj_mask = task.get_true_image(env)
-                print("[DEBUG] goals:", task.goals)
-                print("[DEBUG] obj_id_reverse_mapping keys:", list(env.obj_id_reverse_mapping.keys()))
-                print("[DEBUG] obj_mask unique ids:", np.unique(obj_mask)[:20])
-                print("[DEBUG] obj_mask nonzero count:", np.count_nonzero(obj_mask))
-            except Exception as _e:
-                print("[DEBUG] get_true_image() failed:", _e)
-            
             action = oracle_fn.act(obs)
             if action is None:
                 raise RuntimeError("oracle 返回 None，无法继续。")
-            action = {
-                k: np.clip(v, env.action_space[k].low, env.action_space[k].high)
-                for k, v in action.items()
-            }
-            obs, reward, done, info = env.step(action=action, skip_oracle=False)
+            clip_into(action)
+            # 必须 skip_oracle=False：update_goals(skip_oracle=True) 会跳过 oracle_only 的 goal，
+            # 而 oracle 总是执行 goals[0]，那样 oracle 会卡在未被消费的 goal 上（如 rearrange 类任务）。
+            obs, _, done, last_info = env.step(action=action_dict, skip_oracle=False)
             if done:
-                success = bool(info.get("success"))
                 break
+        success = done and bool(last_info.get("success"))
 
         if not success:
-            err_msg = f"在 {getattr(task, 'oracle_max_steps', 10)} 步内未成功完成任务。 info={info}"
+            err_msg = f"在 {max_steps} 步内未成功完成任务。 info={last_info}"
             if verbose:
                 print("[VERIFY][Step 3] Oracle 检查失败：" + err_msg)
-            env.close()
+            _release_env(env, reuse_env)
             return False, 3, err_msg
 
         if verbose:
             print("[VERIFY][Step 3] Oracle 检查通过，任务可被 oracle 完成。")
-        env.close()
+        _release_env(env, reuse_env)
         return True, None, None
 
     except Exception as e:
         err_msg = str(e)
         if verbose:
             print(f"[VERIFY][Step 3] Oracle 运行中出错：{err_msg}")
-        if env is not None:
-            try:
-                env.close()
-            except Exception:
-                pass
+        _release_env(env, reuse_env, broken=True)
         return False, 3, err_msg
+
+
+def _init_verify_worker() -> None:
+    """worker 进程初始化：与 cli 相同的 OpenMP 设置；env 在首个任务时创建并缓存于本进程。"""
+    os.environ.setdefault("KMP_DUPLICATE_LIB_OK", "TRUE")
+
+
+def _verify_worker(code: str, seed: int) -> tuple[bool, Optional[int], Optional[str]]:
+    return verify_task_code(code, verbose=False, reuse_env=True, seed=seed)
+
+
+def _run_verify_pool(
+    codes: List[str],
+    indices: List[int],
+    n_workers: int,
+    seed: int,
+    results: List[Optional[tuple[bool, Optional[int], Optional[str]]]],
+) -> dict[int, str]:
+    """在一个新进程池中验证 indices 对应的候选，结果写入 results；返回未得到结果的下标及异常信息。"""
+    crashed: dict[int, str] = {}
+    # spawn：不把父进程里的 PyBullet / OpenMP 状态 fork 给 worker
+    with cf.ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_verify_worker,
+    ) as executor:
+        futures = {executor.submit(_verify_worker, codes[i], seed): i for i in indices}
+        for future in cf.as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                crashed[i] = repr(e)
+    return crashed
+
+
+def verify_task_codes(
+    codes: List[str],
+    max_workers: Optional[int] = None,
+    seed: int = _ENV_SEED,
+) -> List[tuple[bool, Optional[int], Optional[str]]]:
+    """
+    批量验证多个候选代码，结果与 codes 一一对应（同 verify_task_code 的返回值）。
+
+    先用 quick_reject 在本进程过滤明显不合格的候选；其余分发到进程池，
+    每个 worker 复用自己缓存的 env（见 _get_env）。某个 worker 异常退出（如 PyBullet
+    段错误）会让整个进程池失效，受影响的候选先整体在一个新进程池中重试，再次崩溃的
+    才逐个单独重试；单独运行仍崩溃的候选返回 (False, None, msg)：这是验证环境故障
+    而非代码在某一步失败，调用方不应记为失败样本。
+    """
+    results: List[Optional[tuple[bool, Optional[int], Optional[str]]]] = [None] * len(codes)
+    pending = []
+    for i, code in enumerate(codes):
+        reject_msg = quick_reject(code)
+        if reject_msg is not None:
+            results[i] = (False, 1, reject_msg)
+        else:
+            pending.append(i)
+
+    if pending:
+        n_workers = max_workers or min(len(pending), os.cpu_count() or 1)
+        crashed = _run_verify_pool(codes, pending, n_workers, seed, results)
+        if crashed:
+            # 先把受影响的候选整体放进一个新进程池重试；再次崩溃的才逐个单独验证
+            crashed = _run_verify_pool(
+                codes, sorted(crashed), min(n_workers, len(crashed)), seed, results
+            )
+        for i in sorted(crashed):
+            retry_crashed = _run_verify_pool(codes, [i], 1, seed, results)
+            if retry_crashed:
+                results[i] = (False, None, f"验证进程异常退出：{retry_crashed[i]}")
+    return results
@@ -13,10 +13,16 @@
 """
 
 import argparse
+import importlib.util
+import os
 import sys
 
-# 确保能 import 到 vima_bench
-sys.path.insert(0, ".")
+# 确保能 import 到 vima_bench；已可导入（如已安装）时不改动 sys.path，避免遮蔽
+if importlib.util.find_spec("vima_bench") is None:
+    sys.path.insert(0, ".")
+# VIMA_Gen 不随 vima_bench 安装，只在仓库里：项目根追加到末尾，同样不会遮蔽已安装的 vima_bench
+if importlib.util.find_spec("VIMA_Gen") is None:
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 
 def verify_task_import_and_reset(task_name: str, seed: int = 42) -> bool:
@@ -45,8 +51,8 @@ def verify_task_import_and_reset(task_name: str, seed: int = 42) -> bool:
 
 def verify_task_with_oracle(task_name: str, seed: int = 42, num_episodes: int = 2) -> bool:
     """创建环境、reset、用 oracle 跑几步，检查是否 done 且 success。"""
-    import numpy as np
     import vima_bench
+    from VIMA_Gen.action_clip import make_action_clipper
 
     print(f"[1/3] 创建环境 (display_debug_window=True) ...")
     env = vima_bench.make(
@@ -58,7 +64,10 @@ def verify_task_with_oracle(task_name: str, seed: int = 42, num_episodes: int =
         hide_arm_rgb=False,
     )
     task = env.task
+    # oracle 只在这里构造一次并在各 episode 间复用：BaseTask.oracle 返回的 act
+    # 每步都从 task.goals 读取当前目标，reset 后无需重建。
     oracle_fn = task.oracle(env)
+    action_dict, clip_into = make_action_clipper(env.action_space)
 
     print(f"[2/3] 运行 {num_episodes} 个 episode (oracle) ...")
     for ep in range(num_episodes):
@@ -74,11 +83,8 @@ def verify_task_with_oracle(task_name: str, seed: int = 42, num_episodes: int =
                 print(f"      Episode {ep}: oracle 返回 None at step {step}")
                 env.close()
                 return False
-            action = {
-                k: np.clip(v, env.action_space[k].low, env.action_space[k].high)
-                for k, v in action.items()
-            }
-            obs, reward, done, info = env.step(action=action, skip_oracle=False)
+            clip_into(action)
+            obs, _, done, info = env.step(action=action_dict, skip_oracle=False)
             if done:
                 ok = "OK" if info.get("success") else "FAIL"
                 print(f"      Episode {ep}: done at step {step+1}, success={info.get('success')} [{ok}]")